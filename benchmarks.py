@@ -0,0 +1,66 @@
+from __future__ import print_function, unicode_literals, absolute_import
+
+import timeit
+# the code path before MetaCodec: stdlib json to encode, ujson (if available) to decode
+from json import dumps as json_dumps
+try:
+    from ujson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from gherkin_utils.tools import MetaCodec, GherkinUtils, MetaUtils
+
+
+def new_scenario_ast(i):
+    return {
+        'name': 'scenario {}'.format(i),
+        'description': 'description of scenario {}'.format(i),
+        'tags': [{'name': '@SID.1.{}'.format(i)}, {'name': '@SUID.{:016d}'.format(i)}, {'name': '@smoke'}],
+        'type': 'Scenario',
+    }
+
+
+def bench(name, func, n, repeat):
+    cost = min(timeit.repeat(func, number=1, repeat=repeat))
+    print('{:<36} {:8.3f} ms / {} summaries'.format(name, cost * 1000, n))
+
+
+def bench_summary_encoding(n=1000, cache_size=4096, repeat=20):
+    scenarios = [new_scenario_ast(i) for i in range(n)]
+    MetaUtils.codec = codec = MetaCodec(cache_size=cache_size)
+
+    def legacy():
+        for i, scenario in enumerate(scenarios):
+            json_dumps(GherkinUtils.new_scenario_summary(scenario, '{:016d}'.format(i), i), separators=(',', ':'))
+
+    def codec_uncached():
+        for i, scenario in enumerate(scenarios):
+            codec.dumps(GherkinUtils.new_scenario_summary(scenario, '{:016d}'.format(i), i))
+
+    def codec_cached():
+        # one full labeling pass, summaries are written in the same order every pass
+        for i, scenario in enumerate(scenarios):
+            GherkinUtils.new_scenario_summary(scenario, '{:016d}'.format(i), i, to_json=True)
+
+    print('encode, backend: {}, cache size: {}'.format(codec.backend, cache_size))
+    bench('legacy json_dumps', legacy, n, repeat)
+    bench('codec', codec_uncached, n, repeat)
+    bench('codec (cached)', codec_cached, n, repeat)
+
+
+def bench_summary_decoding(n=1000, repeat=20):
+    lines = [MetaCodec('json').dumps(GherkinUtils.new_scenario_summary(new_scenario_ast(i), '{:016d}'.format(i), i))
+             for i in range(n)]
+    codec = MetaCodec()
+    print('decode, backend: {}'.format(codec.backend))
+    bench('legacy json_loads', lambda: [json_loads(line) for line in lines], n, repeat)
+    bench('codec', lambda: [codec.loads(line) for line in lines], n, repeat)
+
+
+if __name__ == '__main__':
+    bench_summary_encoding(1000)
+    # more nodes than the cache holds, nothing hits on a sequential pass
+    bench_summary_encoding(10000, repeat=5)
+    # cache reserved for all nodes, as LabelingTask.prepare does
+    bench_summary_encoding(10000, cache_size=20000, repeat=5)
+    bench_summary_decoding()
@@ -5,16 +5,18 @@ import os
 import time
 import traceback
 import codecs
+import binascii
+import threading
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from collections import deque
+from array import array
 from cStringIO import StringIO
-try:
-    from ujson import loads as json_loads
-except ImportError:
-    from json import loads as json_loads
-from json import dumps as json_dumps
 
 import base32_crockford
 import git.exc
-from git import Repo
+from git import Repo, PushInfo
 from gherkin.tools import parse_gherkin, write_gherkin
 from Crypto.Random.random import StrongRandom
 
@@ -55,6 +57,8 @@ class LabelingTask(Task):
     _remote = None
     _fid_idx = None
     _sid_idx = None
+    _fid_block = None
+    _sid_blocks = None
 
     @classmethod
     def labeling_file_in_repo(cls, repo_path, file_path):
@@ -62,7 +66,8 @@ class LabelingTask(Task):
         task.prepare()
         task.process_file(file_path, create_commit=False)
 
-    def __init__(self, path, url=None, branches=(), fetch_remote=True, rebase_to=None, push_to_remote=False):
+    def __init__(self, path, url=None, branches=(), fetch_remote=True, rebase_to=None, push_to_remote=False,
+                 id_store=None):
         self._path = path
         self._url = url
         self._branches = branches
@@ -72,6 +77,7 @@ class LabelingTask(Task):
         self._fetch_remote = fetch_remote
         self._push_to_remote = push_to_remote
         self._rebase_to = rebase_to
+        self._id_store = id_store  # type: IdLeaseStore
 
     def prepare(self):
         if os.path.isdir(self._path):
@@ -82,6 +88,19 @@ class LabelingTask(Task):
             self._repo.git.fetch()
         self._remote = self._repo.remote()
         self._fid_idx, self._sid_idx = MetaUtils.git_build_meta_index(self._repo)
+        self._fid_block, self._sid_blocks = None, {}
+        # room for every feature and scenario, with some spare for new ones
+        MetaUtils.codec.reserve_cache(2 * (len(self._fid_idx) + len(self._sid_idx)))
+
+    def clean(self):
+        # return unused ids so that other labeling jobs can use them
+        if self._id_store is None:
+            return
+        if self._fid_block is not None:
+            self._id_store.release(IdLeaseStore.FID_SCOPE, *self._fid_block)
+        for fuid, sid_block in (self._sid_blocks or {}).items():
+            self._id_store.release(fuid, *sid_block)
+        self._fid_block, self._sid_blocks = None, {}
 
     def process_branches(self):
         if self._rebase_to is not None:
@@ -91,23 +110,44 @@ class LabelingTask(Task):
                 self.process_branch(branch)
 
     def process_branch(self, branch_name):
+        # return True if the branch is labeled (and pushed) without error
         try:
             self.do_process_branch(branch_name)
         except Exception as e:
             print_error(e)
+            return False
+        else:
+            return True
         finally:
             self._processed_branches.add(branch_name)
 
-    def do_process_branch(self, branch_name):
+    def checkout_branch(self, branch_name):
         self._repo.git.checkout([branch_name])
-        if self._rebase_to is not None and self._rebase_to != branch_name:
-            self._repo.git.rebase([self._rebase_to])
+
+    def get_rebase_target(self):
+        return self._rebase_to
+
+    def push_branch(self, branch_name, force_with_lease=False):
+        infos = self._remote.push(branch_name, force_with_lease=force_with_lease)
+        failed_flags = PushInfo.ERROR | PushInfo.REJECTED | PushInfo.REMOTE_REJECTED | PushInfo.REMOTE_FAILURE
+        if not infos:
+            raise ValueError('failed to push branch: {}'.format(branch_name))
+        for info in infos:
+            if info.flags & failed_flags:
+                raise ValueError('failed to push branch: {}, {}'.format(branch_name, info.summary))
+
+    def do_process_branch(self, branch_name):
+        self.checkout_branch(branch_name)
+        rebased = self._rebase_to is not None and self._rebase_to != branch_name
+        if rebased:
+            self._repo.git.rebase([self.get_rebase_target()])
         paths = self.get_feature_files()
         for path in paths:
             path = os.path.join(self._repo.working_dir, path)
             self.process_file(path)
         if self._push_to_remote:
-            self._remote.push(branch_name)
+            # rebased branch is not a fast-forward of the remote one
+            self.push_branch(branch_name, force_with_lease=rebased)
 
     def do_run(self):
         self.process_branches()
@@ -125,15 +165,30 @@ class LabelingTask(Task):
             print_error(e)
 
     def new_fid(self):
-        if len(self._fid_idx) > 0:
-            return max(self._fid_idx) + 1
-        return 1
+        fid = max(self._fid_idx) + 1 if len(self._fid_idx) > 0 else 1
+        if self._id_store is None:
+            return fid
+        while True:
+            if self._fid_block is None or self._fid_block[0] >= self._fid_block[1]:
+                self._fid_block = list(self._id_store.lease(IdLeaseStore.FID_SCOPE, fid))
+            fid = self._fid_block[0]
+            self._fid_block[0] += 1
+            if fid not in self._fid_idx:
+                return fid
 
     def new_sid(self, fuid):
         sub_sid_idx = [_sid for _fuid, _sid in self._sid_idx if _fuid == fuid]
-        if len(sub_sid_idx) > 0:
-            return max(sub_sid_idx) + 1
-        return 1
+        sid = max(sub_sid_idx) + 1 if len(sub_sid_idx) > 0 else 1
+        if self._id_store is None:
+            return sid
+        while True:
+            sid_block = self._sid_blocks.get(fuid)
+            if sid_block is None or sid_block[0] >= sid_block[1]:
+                sid_block = self._sid_blocks[fuid] = list(self._id_store.lease(fuid, sid))
+            sid = sid_block[0]
+            sid_block[0] += 1
+            if (fuid, sid) not in self._sid_idx:
+                return sid
 
     def do_process_file(self, path, create_commit):
         gherkin_ast = GherkinUtils.parse_gherkin(path)
@@ -142,7 +197,9 @@ class LabelingTask(Task):
         if fuid is not None and fid is not None:
             fuid_set = self._fid_idx[fid]
             if len(fuid_set) > 1 and min(fuid_set) != fuid:  # handle duplication
-                fid = self._resolved_fuids.get(fuid, self.new_fid())
+                fid = self._resolved_fuids.get(fuid)
+                if fid is None:  # new_fid may consume a leased id, so don't call it eagerly
+                    fid = self.new_fid()
                 self._fid_idx.setdefault(fid, set()).add(fuid)
                 self._resolved_fuids[fuid] = fid  # set this so that we won't resolve same fuid again
         else:  # create new meta
@@ -159,7 +216,9 @@ class LabelingTask(Task):
             if suid is not None and sid is not None:
                 suid_set = self._sid_idx[(fuid, sid)]
                 if len(suid_set) > 1 and min(suid_set) != (fuid, suid):
-                    sid = self._resolved_suids.get((fuid, suid), self.new_sid(fuid))
+                    sid = self._resolved_suids.get((fuid, suid))
+                    if sid is None:
+                        sid = self.new_sid(fuid)
                     self._sid_idx.setdefault((fuid, sid), set()).add((fuid, suid))
                     self._resolved_suids[(fuid, suid)] = sid
             else:  # create new meta
@@ -176,6 +235,354 @@ class LabelingTask(Task):
             self._repo.git.commit(['-m', 'meta: update file: {}'.format(rel_path)])
 
 
+class LabelingDaemon(LabelingTask):
+    """
+    Long-running labeling task which keeps repo, meta index and id counters in memory,
+    and only labels branches whose heads have changed (or are triggered by `trigger`).
+    If the upstream is not on local disk, its refs can't be watched, so it is fetched every `fetch_interval`
+    seconds, use `trigger` to label a branch sooner. Branches failed to be labeled are retried on next fetch.
+    """
+    _watch_dir = None
+    _refs_stamp = None
+    _branch_heads = None
+
+    def __init__(self, path, url=None, branches=(), fetch_remote=True, rebase_to=None, push_to_remote=False,
+                 id_store=None, watch_dir=None, poll_interval=1.0, fetch_interval=60.0):
+        super(LabelingDaemon, self).__init__(path, url, branches, fetch_remote, rebase_to, push_to_remote, id_store)
+        self._watch_dir_hint = watch_dir
+        self._poll_interval = poll_interval
+        self._fetch_interval = fetch_interval
+        self._last_fetch_time = 0
+        self._failed_branches = set()
+        self._triggered_branches = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def prepare(self):
+        super(LabelingDaemon, self).prepare()
+        self._watch_dir = self._watch_dir_hint or self.get_default_watch_dir()
+        self._refs_stamp = self.get_refs_stamp()
+        self._branch_heads = self.get_branch_heads()
+
+    def get_default_watch_dir(self):
+        # watch the upstream repo directly if it is on local disk (e.g. a bare repo),
+        # otherwise there is nothing to watch and the remote is fetched every fetch_interval
+        url = self._url or self._remote.url
+        if url is not None and os.path.isdir(url):
+            return maybe_repo(url).git_dir
+        return None
+
+    def get_refs_stamp(self):
+        if self._watch_dir is None:
+            return None
+        stamp = []
+        paths = [os.path.join(self._watch_dir, 'packed-refs')]
+        for root, _dirs, files in os.walk(os.path.join(self._watch_dir, 'refs')):
+            paths.extend(os.path.join(root, file_name) for file_name in files)
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stamp.append((path, st.st_ino, st.st_size, st.st_mtime))
+        stamp.sort()
+        return stamp
+
+    def get_branch_heads(self):
+        prefix = 'refs/remotes/{}/'.format(self._remote.name)
+        stdout = self._repo.git.for_each_ref(['--format=%(objectname) %(refname)', prefix])
+        heads = {}
+        for line in stdout.splitlines():
+            object_id, ref_name = line.split(' ', 1)
+            branch_name = ref_name[len(prefix):]
+            if 'HEAD' != branch_name:
+                heads[branch_name] = object_id
+        return heads
+
+    def trigger(self, *branches):
+        with self._lock:
+            self._triggered_branches.update(branches)
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def pop_triggered_branches(self):
+        with self._lock:
+            branches, self._triggered_branches = self._triggered_branches, set()
+        return branches
+
+    def checkout_branch(self, branch_name):
+        # local branches may be stale, always start over from the remote head
+        self._repo.git.checkout(['-B', branch_name, '{}/{}'.format(self._remote.name, branch_name)])
+
+    def get_rebase_target(self):
+        # local rebase_to branch may be stale or even not exist
+        return '{}/{}'.format(self._remote.name, self._rebase_to)
+
+    def do_process_branch(self, branch_name):
+        try:
+            super(LabelingDaemon, self).do_process_branch(branch_name)
+        except Exception:
+            # don't leave the work tree in the middle of a rebase, or all following checkouts will fail
+            try:
+                self._repo.git.rebase(['--abort'])
+            except git.exc.GitCommandError:
+                pass  # not in a rebase
+            raise
+
+    def update_meta_index(self, branches):
+        refs = ['{}/{}'.format(self._remote.name, branch) for branch in branches]
+        MetaUtils.git_build_meta_index(self._repo, refs, self._fid_idx, self._sid_idx)
+
+    def poll(self):
+        """
+        :return: branches labeled in this round
+        """
+        branches = self.pop_triggered_branches()
+        stamp = self.get_refs_stamp()
+        now = time.time()
+        fetch_due = now - self._last_fetch_time >= self._fetch_interval
+        if stamp is None:
+            refs_changed = fetch_due
+        else:
+            refs_changed = stamp != self._refs_stamp or (bool(self._failed_branches) and fetch_due)
+        # triggered branches must be fetched to label their latest heads
+        if not (branches or refs_changed):
+            return set()
+        self._refs_stamp = stamp
+        self._last_fetch_time = now
+        if self._fetch_remote:
+            self._repo.git.fetch()
+        heads = self.get_branch_heads()
+        branches.update(branch for branch, object_id in heads.items()
+                        if self._branch_heads.get(branch) != object_id)
+        if self._branches:
+            allowed = set(self._branches)
+            if self._rebase_to is not None:
+                allowed.add(self._rebase_to)
+            branches.intersection_update(allowed)
+        branches.intersection_update(heads)
+        if not branches:
+            self._branch_heads = heads
+            return set()
+
+        self.update_meta_index(branches)
+        labeled = set()
+        if self._rebase_to is not None and self._rebase_to in branches:
+            if self.process_branch(self._rebase_to):
+                labeled.add(self._rebase_to)
+        for branch in sorted(branches):
+            if branch != self._rebase_to and self.process_branch(branch):
+                labeled.add(branch)
+        # absorb heads moved by our own pushes so that they won't trigger another round,
+        # but forget heads of failed branches so that they will be labeled again on next fetch
+        self._failed_branches = branches - labeled
+        self._branch_heads = self.get_branch_heads()
+        for branch in self._failed_branches:
+            self._branch_heads.pop(branch, None)
+        return labeled
+
+    def do_run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print_error(e)
+            self._wakeup.wait(self._poll_interval)
+            self._wakeup.clear()
+
+
+class IdLeaseStore(object):
+    """
+    Lease contiguous blocks of FIDs (scope FID_SCOPE) and SIDs (scope is the FUID) from a shared SQLite db,
+    so that labeling jobs running in different processes on the same host won't allocate same ids.
+    The db file must be on a local filesystem, SQLite locking is not reliable on network filesystems,
+    use GitRefIdLeaseStore to share ids across hosts.
+    Blocks are half-open ranges [start, stop), unused ranges should be returned with `release`.
+    """
+    FID_SCOPE = ''
+
+    def __init__(self, db_path, block_size=32, timeout=60.0):
+        self._db_path = db_path
+        self._block_size = block_size
+        self._timeout = timeout
+        with self.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS id_counter (scope TEXT PRIMARY KEY, next_id INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS id_free (scope TEXT NOT NULL, start INTEGER NOT NULL, '
+                         'stop INTEGER NOT NULL)')
+
+    def connect(self):
+        # autocommit mode, transactions are controlled by hand
+        return sqlite3.connect(self._db_path, timeout=self._timeout, isolation_level=None)
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')  # take the write lock at once to serialize leasing
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def lease(self, scope, floor=1, size=None):
+        """
+        :param floor: ids lower than floor are known to be used (e.g. found in repo) and will not be leased
+        :return: (start, stop)
+        """
+        size = size or self._block_size
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM id_free WHERE scope = ? AND stop <= ?', (scope, floor))
+            row = conn.execute('SELECT rowid, start, stop FROM id_free WHERE scope = ? ORDER BY start LIMIT 1',
+                               (scope,)).fetchone()
+            if row is not None:
+                rowid, start, stop = row
+                start = max(start, floor)
+                stop = min(stop, start + size)
+                conn.execute('DELETE FROM id_free WHERE rowid = ?', (rowid,))
+                if stop < row[2]:
+                    conn.execute('INSERT INTO id_free (scope, start, stop) VALUES (?, ?, ?)', (scope, stop, row[2]))
+                return start, stop
+
+            row = conn.execute('SELECT next_id FROM id_counter WHERE scope = ?', (scope,)).fetchone()
+            start = floor if row is None else max(row[0], floor)
+            stop = start + size
+            conn.execute('INSERT OR REPLACE INTO id_counter (scope, next_id) VALUES (?, ?)', (scope, stop))
+            return start, stop
+
+    def release(self, scope, start, stop):
+        if start >= stop:
+            return
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO id_free (scope, start, stop) VALUES (?, ?, ?)', (scope, start, stop))
+
+
+class GitRefIdLeaseStore(object):
+    """
+    Same as IdLeaseStore, but the lease state is kept in a commit pointed by `ref` and updated by compare-and-swap:
+    `git update-ref <ref> <new> <old>` in the local repo, or a push to `remote` when it is given,
+    so that labeling jobs on different hosts can share ids through the remote.
+    Every new state commit takes the state it's based on as parent, so the push is rejected as non-fast-forward
+    if another job updated the ref in between, then the update is retried on top of the new state.
+    """
+    FID_SCOPE = IdLeaseStore.FID_SCOPE
+    STATE_FILE = 'leases.json'
+
+    def __init__(self, repo_or_path, ref='refs/meta/id-leases', remote=None, block_size=32, retries=20):
+        self._repo = maybe_repo(repo_or_path)
+        self._ref = ref
+        self._remote = remote
+        self._block_size = block_size
+        self._retries = retries
+
+    @staticmethod
+    def new_state():
+        return {'counters': {}, 'free': {}}
+
+    def read_state(self):
+        """
+        :return: (commit id or None if ref doesn't exist, state)
+        """
+        if self._remote is not None:
+            stdout = self._repo.git.ls_remote([self._remote, self._ref])
+            # ls-remote matches ref names by suffix
+            commit_ids = [line.split('\t', 1)[0] for line in stdout.splitlines() if line.endswith('\t' + self._ref)]
+            if not commit_ids:
+                return None, self.new_state()
+            commit_id = commit_ids[0]
+            self._repo.git.fetch([self._remote, '+{0}:{0}'.format(self._ref)])
+        else:
+            try:
+                commit_id = self._repo.git.rev_parse(['--verify', '-q', self._ref + '^{commit}'])
+            except git.exc.GitCommandError:
+                return None, self.new_state()
+        data = self._repo.git.show(['{}:{}'.format(commit_id, self.STATE_FILE)])
+        return commit_id, MetaUtils.codec.loads(data)
+
+    def _git_with_input(self, method, args, data):
+        with tempfile.TemporaryFile() as fp:
+            fp.write(data.encode('utf-8'))
+            fp.seek(0)
+            return method(args, istream=fp)
+
+    def write_state(self, state, parent_id):
+        blob_id = self._git_with_input(self._repo.git.hash_object, ['-w', '--stdin'], MetaUtils.codec.dumps(state))
+        tree_id = self._git_with_input(self._repo.git.mktree, [],
+                                       '100644 blob {}\t{}\n'.format(blob_id, self.STATE_FILE))
+        # make the commit unique, or jobs computing the same state at the same second would create the same commit,
+        # and the later push would succeed as "up to date"
+        args = [tree_id, '-m', 'update id leases: {}'.format(binascii.hexlify(os.urandom(8)).decode('ascii'))]
+        if parent_id is not None:
+            args += ['-p', parent_id]
+        return self._repo.git.commit_tree(args)
+
+    def compare_and_swap(self, old_id, new_id):
+        # raise GitCommandError if ref is not old_id any more
+        if self._remote is not None:
+            self._repo.git.push([self._remote, '{}:{}'.format(new_id, self._ref)])
+            self._repo.git.update_ref([self._ref, new_id])
+        else:
+            self._repo.git.update_ref([self._ref, new_id, old_id or '0' * 40])
+
+    def update(self, func):
+        """
+        apply func to the state and save it atomically, retry if the state is updated by others at the same time
+        :return: return value of func
+        """
+        error = None
+        for attempt in range(self._retries):
+            try:
+                old_id, state = self.read_state()
+                ret = func(state)
+                self.compare_and_swap(old_id, self.write_state(state, old_id))
+                return ret
+            except git.exc.GitCommandError as e:
+                error = e
+                time.sleep(0.01 * (attempt + 1))
+        raise error
+
+    def lease(self, scope, floor=1, size=None):
+        """
+        :param floor: ids lower than floor are known to be used (e.g. found in repo) and will not be leased
+        :return: (start, stop)
+        """
+        size = size or self._block_size
+
+        def do_lease(state):
+            free = sorted(r for r in state['free'].get(scope, []) if r[1] > floor)
+            if free:
+                start, stop = free.pop(0)
+                start = max(start, floor)
+                end = min(stop, start + size)
+                if end < stop:
+                    free.append([end, stop])
+                if free:
+                    state['free'][scope] = free
+                else:
+                    state['free'].pop(scope, None)
+                return start, end
+            start = max(state['counters'].get(scope, floor), floor)
+            state['counters'][scope] = start + size
+            return start, start + size
+        return self.update(do_lease)
+
+    def release(self, scope, start, stop):
+        if start >= stop:
+            return
+
+        def do_release(state):
+            state['free'].setdefault(scope, []).append([start, stop])
+        self.update(do_release)
+
+
 class GherkinUtils(object):
 
     @staticmethod
@@ -340,7 +747,8 @@ class GherkinUtils(object):
             'fid': fid,
         }
         if to_json:
-            return json_dumps(summary, separators=(',', ':'))
+            key = ('F', summary['name'], summary['description'], tuple(summary['tags']), fuid, fid)
+            return MetaUtils.codec.dumps_cached(key, summary)
         return summary
 
     @classmethod
@@ -354,7 +762,8 @@ class GherkinUtils(object):
             'type': scenario_ast['type'],
         }
         if to_json:
-            return json_dumps(summary, separators=(',', ':'))
+            key = ('S', summary['name'], summary['description'], tuple(summary['tags']), suid, sid, summary['type'])
+            return MetaUtils.codec.dumps_cached(key, summary)
         return summary
 
     @classmethod
@@ -404,7 +813,67 @@ class GherkinUtils(object):
         write_gherkin(gherkin_ast, fp)
 
 
+class MetaCodec(object):
+    """
+    Compact json codec of meta summaries, the fastest available backend is used for both encode and decode.
+    Encoded summaries are cached by a key of the fields they are built from, the oldest ones are evicted first.
+    The cache should hold all nodes of a repo to hit on a full labeling pass, see `reserve_cache`.
+    """
+    BACKENDS = ('ujson', 'json')  # fastest first
+
+    def __init__(self, backend=None, cache_size=4096):
+        for name in ((backend,) if backend else self.BACKENDS):
+            try:
+                self.dumps, self.loads = self.new_backend(name)
+            except ImportError:
+                continue
+            self.backend = name
+            break
+        else:
+            raise ValueError('no json backend is available: {}'.format(backend))
+        # a hit must be cheaper than encoding, so lookup is a plain dict and eviction order is kept aside
+        self._cache = {}
+        self._cache_keys = deque()
+        self._cache_size = cache_size
+
+    @staticmethod
+    def new_backend(name):
+        if 'ujson' == name:
+            import ujson
+            try:
+                ujson.dumps('', escape_forward_slashes=False)
+            except TypeError:
+                raise ImportError('ujson is too old to support escape_forward_slashes')
+
+            def dumps(obj):
+                # keep output the same as stdlib json, so that meta lines won't change with backend,
+                # DEL is the only character that ujson doesn't escape while stdlib json does
+                data = ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+                if '\x7f' in data:
+                    data = data.replace('\x7f', '\\u007f')
+                return data
+            return dumps, ujson.loads
+        elif 'json' == name:
+            import json
+            return json.JSONEncoder(separators=(',', ':')).encode, json.loads
+        raise ValueError('unknown json backend: {}'.format(name))
+
+    def reserve_cache(self, size):
+        # only grows, so that jobs sharing the codec won't shrink the cache of each other
+        self._cache_size = max(self._cache_size, size)
+
+    def dumps_cached(self, key, obj):
+        data = self._cache.get(key)
+        if data is None:
+            data = self._cache[key] = self.dumps(obj)
+            self._cache_keys.append(key)
+            while len(self._cache_keys) > self._cache_size:
+                del self._cache[self._cache_keys.popleft()]
+        return data
+
+
 class MetaUtils(object):
+    codec = MetaCodec()
     META_PATTERN = '^ *?# META '
     META_F_PREFIX = '# META F '
     META_S_PREFIX = '# META S '
@@ -418,14 +887,14 @@ class MetaUtils(object):
                 try:
                     if line.startswith(cls.META_F_PREFIX):
                         _fuid, _fid, data = cls.split_feature_meta(line)
-                        summary = json_loads(data)
+                        summary = cls.codec.loads(data)
                         summary['_file_path'] = file_path
                         summary['_fuid'] = _fuid
                         summary['_fid'] = _fid
                         feature = summary
                     elif line.startswith(cls.META_S_PREFIX):
                         _fuid, _suid, _sid, data = cls.split_scenario_meta(line)
-                        summary = json_loads(data)
+                        summary = cls.codec.loads(data)
                         summary['_file_path'] = file_path
                         summary['_fuid'] = _fuid
                         summary['_suid'] = _suid
@@ -468,15 +937,19 @@ class MetaUtils(object):
         return None
 
     @staticmethod
-    def git_grep_features(repo_or_path, pattern, refs=None, glob_pattern='*.feature'):
-        # type: (Repo, basestring, ...) -> ...
-        repo = maybe_repo(repo_or_path)
+    def new_grep_cmd(repo, pattern, refs=None, glob_pattern='*.feature'):
         if isinstance(refs, list):
-            cmd = ['--extended-regexp', pattern] + refs + ['--', glob_pattern]
+            return ['--extended-regexp', pattern] + refs + ['--', glob_pattern]
         elif isinstance(refs, basestring):
-            cmd = ['--extended-regexp', pattern, refs, '--', glob_pattern]
+            return ['--extended-regexp', pattern, refs, '--', glob_pattern]
         else:
-            cmd = ['--extended-regexp', pattern, repo.active_branch.name, '--', glob_pattern]
+            return ['--extended-regexp', pattern, repo.active_branch.name, '--', glob_pattern]
+
+    @classmethod
+    def git_grep_features(cls, repo_or_path, pattern, refs=None, glob_pattern='*.feature'):
+        # type: (Repo, basestring, ...) -> ...
+        repo = maybe_repo(repo_or_path)
+        cmd = cls.new_grep_cmd(repo, pattern, refs, glob_pattern)
         stdout = ''
         try:
             stdout = repo.git.grep(cmd)
@@ -485,6 +958,58 @@ class MetaUtils(object):
                 raise e
         return stdout
 
+    @classmethod
+    def git_iter_grep_features(cls, repo_or_path, pattern, refs=None, glob_pattern='*.feature', null=False):
+        # same as git_grep_features, but yield lines as git outputs them instead of buffering the whole output,
+        # with null=True lines are "<ref>:<file name>\0<line>" and file names are not C-quoted
+        repo = maybe_repo(repo_or_path)
+        cmd = cls.new_grep_cmd(repo, pattern, refs, glob_pattern)
+        if null:
+            cmd = ['--null'] + cmd
+        proc = repo.git.grep(cmd, as_process=True)
+        for line in proc.stdout:
+            yield line.decode('utf-8')
+        try:
+            proc.wait()
+        except git.exc.GitCommandError as e:
+            if e.status != 1:  # git grep will return status 1 when nothing is match
+                raise e
+
+    @classmethod
+    def git_export_meta(cls, repo_or_path, out_path, refs=None, skip_error=False):
+        """
+        export all meta records of `refs` (all refs by default) to a columnar file in a single streaming pass,
+        the format is decided by extension of `out_path`, see MetaColumns.save
+        """
+        repo = maybe_repo(repo_or_path)
+        if refs is None:
+            refs = [ref.name for ref in repo.refs]
+        columns = MetaColumns()
+        feature_key, feature_fid = None, None  # scenarios take fid of the feature in the same file
+        for line in cls.git_iter_grep_features(repo, cls.META_PATTERN, refs, null=True):
+            try:
+                name, meta = line.split('\0', 1)
+                ref, file_name = name.split(':', 1)  # ref name can't contain ':' but file name can
+                meta = meta.lstrip(' ')
+                if meta.startswith(cls.META_F_PREFIX):
+                    fuid, fid, data = cls.split_feature_meta(meta)
+                    summary = cls.codec.loads(data)
+                    feature_key, feature_fid = (ref, file_name), fid
+                    columns.append(ref, file_name, fuid, fid, None, None, 'Feature',
+                                   summary.get('name'), summary.get('tags'))
+                elif meta.startswith(cls.META_S_PREFIX):
+                    fuid, suid, sid, data = cls.split_scenario_meta(meta)
+                    summary = cls.codec.loads(data)
+                    fid = feature_fid if (ref, file_name) == feature_key else None
+                    columns.append(ref, file_name, fuid, fid, suid, sid, summary.get('type'),
+                                   summary.get('name'), summary.get('tags'))
+            except Exception as e:
+                if not skip_error:
+                    raise e
+                print_error(e)
+        columns.save(out_path)
+        return columns
+
     @classmethod
     def git_get_features_meta(cls, repo_or_path, refs=None, fuid=None, with_children=False, index_children=False,
                               skip_error=False):
@@ -500,7 +1025,7 @@ class MetaUtils(object):
                 meta = meta.lstrip(' ')
                 if meta.startswith(cls.META_F_PREFIX):
                     _fuid, _fid, data = cls.split_feature_meta(meta)
-                    summary = json_loads(data)
+                    summary = cls.codec.loads(data)
                     summary['_ref'] = ref
                     summary['_file_name'] = file_name
                     summary['_fuid'] = _fuid
@@ -509,7 +1034,7 @@ class MetaUtils(object):
                     features_idx[(ref, file_name)] = summary
                 elif meta.startswith(cls.META_S_PREFIX):
                     _fuid, _suid, _sid, data = cls.split_scenario_meta(meta)
-                    summary = json_loads(data)
+                    summary = cls.codec.loads(data)
                     summary['_ref'] = ref
                     summary['_file_name'] = file_name
                     summary['_fuid'] = _fuid
@@ -539,7 +1064,7 @@ class MetaUtils(object):
                 meta = meta.lstrip(' ')
                 if meta.startswith(cls.META_S_PREFIX):
                     _fuid, _suid, _sid, data = cls.split_scenario_meta(meta)
-                    summary = json_loads(data)
+                    summary = cls.codec.loads(data)
                     summary['_ref'] = ref
                     summary['_file_name'] = file_name
                     summary['_fuid'] = _fuid
@@ -577,14 +1102,107 @@ class MetaUtils(object):
         else:
             return [os.path.join(repo.working_dir, path) for path in paths]
 
+    @staticmethod
+    def git_diff_feature_blobs(repo_or_path, old_ref, new_ref, glob_pattern='*.feature'):
+        """
+        :return: [(old_blob_id or None, new_blob_id or None, file_name)] of feature files differ between refs
+        """
+        repo = maybe_repo(repo_or_path)
+        # -z to keep file names verbatim instead of C-quoted, records are "<others>\0<file name>\0"
+        cmd = ('-r', '-z', '--no-renames', old_ref, new_ref, '--', glob_pattern)
+        stdout = repo.git.diff_tree(cmd)
+        null_id = '0' * 40
+        ret = []
+        fields = stdout.split('\0')
+        for others, file_name in zip(fields[0::2], fields[1::2]):
+            _old_mode, _new_mode, old_id, new_id, _status = others.split(' ')
+            ret.append((None if null_id == old_id else old_id, None if null_id == new_id else new_id, file_name))
+        return ret
+
     @classmethod
-    def git_build_meta_index(cls, repo_or_path):
-        # type: (Repo) -> ...
+    def git_get_blob_meta(cls, repo_or_path, blob_id, file_name, features, scenarios, skip_error=False):
+        # only "# META" lines are parsed, features and scenarios are indexed by fuid and suid
         repo = maybe_repo(repo_or_path)
-        refs = [ref.name for ref in repo.refs]
-        stdout = cls.git_grep_features(repo, cls.META_PATTERN, refs)
+        _hexsha, _type, _size, content = repo.git.get_object_data(blob_id)
+        for line in content.decode('utf-8').splitlines():
+            line = line.lstrip(' ')
+            try:
+                if line.startswith(cls.META_F_PREFIX):
+                    _fuid, _fid, data = cls.split_feature_meta(line)
+                    summary = cls.codec.loads(data)
+                    summary['_file_name'] = file_name
+                    summary['_fuid'] = _fuid
+                    summary['_fid'] = _fid
+                    features[_fuid] = summary
+                elif line.startswith(cls.META_S_PREFIX):
+                    _fuid, _suid, _sid, data = cls.split_scenario_meta(line)
+                    summary = cls.codec.loads(data)
+                    summary['_file_name'] = file_name
+                    summary['_fuid'] = _fuid
+                    summary['_suid'] = _suid
+                    summary['_sid'] = _sid
+                    scenarios[_suid] = summary
+            except Exception as e:
+                if not skip_error:
+                    raise e
+                print_error(e)
+
+    @classmethod
+    def git_diff_meta(cls, repo_or_path, old_ref, new_ref, skip_error=False):
+        """
+        diff meta between refs, only feature files that differ between refs are read
+        :return: {'features': {fuid: change}, 'scenarios': {suid: change}}, see diff_summaries
+        """
+        repo = maybe_repo(repo_or_path)
+        old_features, old_scenarios, new_features, new_scenarios = {}, {}, {}, {}
+        for old_id, new_id, file_name in cls.git_diff_feature_blobs(repo, old_ref, new_ref):
+            if old_id is not None:
+                cls.git_get_blob_meta(repo, old_id, file_name, old_features, old_scenarios, skip_error)
+            if new_id is not None:
+                cls.git_get_blob_meta(repo, new_id, file_name, new_features, new_scenarios, skip_error)
+        return {
+            'features': cls.diff_summaries(old_features, new_features, ('_fid', '_file_name', 'name',
+                                                                        'description', 'tags')),
+            'scenarios': cls.diff_summaries(old_scenarios, new_scenarios, ('_fuid', '_sid', '_file_name', 'name',
+                                                                           'description', 'tags', 'type')),
+        }
+
+    @staticmethod
+    def diff_summaries(old, new, keys):
+        """
+        :param old: {uid: summary}
+        :param new: {uid: summary}
+        :param keys: keys of summary to compare
+        :return: {uid: {'status': 'added'|'removed'|'modified', 'old': ..., 'new': ..., 'changes': [key]}},
+                 unchanged uids are omitted, a renamed or retagged node is 'modified' with 'name' or 'tags' in changes
+        """
+        ret = {}
+        for uid, old_summary in old.items():
+            new_summary = new.get(uid)
+            if new_summary is None:
+                ret[uid] = {'status': 'removed', 'old': old_summary, 'new': None, 'changes': []}
+                continue
+            changes = [key for key in keys if old_summary.get(key) != new_summary.get(key)]
+            if changes:
+                ret[uid] = {'status': 'modified', 'old': old_summary, 'new': new_summary, 'changes': changes}
+        for uid, new_summary in new.items():
+            if uid not in old:
+                ret[uid] = {'status': 'added', 'old': None, 'new': new_summary, 'changes': []}
+        return ret
+
+    @classmethod
+    def git_build_meta_index(cls, repo_or_path, refs=None, fid_idx=None, sid_idx=None):
+        # type: (Repo, ...) -> ...
+        # pass fid_idx and sid_idx to merge meta of `refs` into an existing index
+        repo = maybe_repo(repo_or_path)
+        if refs is None:
+            refs = [ref.name for ref in repo.refs]
+        fid_idx = {} if fid_idx is None else fid_idx
+        sid_idx = {} if sid_idx is None else sid_idx
+        if not refs:
+            return fid_idx, sid_idx
 
-        fid_idx, sid_idx = {}, {}
+        stdout = cls.git_grep_features(repo, cls.META_PATTERN, list(refs))
         if not stdout:
             return fid_idx, sid_idx
 
@@ -674,6 +1292,103 @@ class MetaUtils(object):
         return fuid, suid, sid, data
 
 
+class MetaColumns(object):
+    """
+    Column store of meta records, string columns are dictionary encoded,
+    tags are stored as a list column (flatten codes + offsets).
+    Missing fid/sid are stored as -1 (sid of features), missing strings as empty string.
+    """
+    STR_COLUMNS = ('ref', 'path', 'fuid', 'suid', 'type', 'name')
+    INT_COLUMNS = ('fid', 'sid')
+
+    def __init__(self):
+        self._dicts = dict((col, {}) for col in self.STR_COLUMNS + ('tags',))
+        self._codes = dict((col, array(b'i')) for col in self.STR_COLUMNS + ('tags',))
+        self._ints = dict((col, array(b'l')) for col in self.INT_COLUMNS)
+        self._tags_offsets = array(b'l', [0])
+
+    def __len__(self):
+        return len(self._tags_offsets) - 1
+
+    def _encode(self, col, value):
+        value = '' if value is None else value
+        col_dict = self._dicts[col]
+        code = col_dict.get(value)
+        if code is None:
+            code = col_dict[value] = len(col_dict)
+        self._codes[col].append(code)
+
+    def append(self, ref, path, fuid, fid, suid, sid, type_, name, tags):
+        for col, value in zip(self.STR_COLUMNS, (ref, path, fuid, suid, type_, name)):
+            self._encode(col, value)
+        self._ints['fid'].append(-1 if fid is None else fid)
+        self._ints['sid'].append(-1 if sid is None else sid)
+        for tag in tags or ():
+            self._encode('tags', tag)
+        self._tags_offsets.append(len(self._codes['tags']))
+
+    def get_dictionary(self, col):
+        values = [None] * len(self._dicts[col])
+        for value, code in self._dicts[col].items():
+            values[code] = value
+        return values
+
+    def to_dict(self):
+        """
+        :return: {'<col>_codes': ..., '<col>_dict': ..., 'fid': ..., 'sid': ..., 'tags_offsets': ...}
+        """
+        ret = {}
+        for col in self.STR_COLUMNS + ('tags',):
+            ret[col + '_codes'] = self._codes[col]
+            ret[col + '_dict'] = self.get_dictionary(col)
+        for col in self.INT_COLUMNS:
+            ret[col] = self._ints[col]
+        ret['tags_offsets'] = self._tags_offsets
+        return ret
+
+    def to_arrow_table(self):
+        import pyarrow as pa
+
+        def dict_array(col):
+            indices = pa.array(list(self._codes[col]), type=pa.int32())
+            return pa.DictionaryArray.from_arrays(indices, pa.array(self.get_dictionary(col), type=pa.string()))
+
+        names, arrays = [], []
+        for col in ('ref', 'path', 'fuid', 'fid', 'suid', 'sid', 'type', 'name'):
+            names.append(col)
+            if col in self.INT_COLUMNS:
+                arrays.append(pa.array(list(self._ints[col]), type=pa.int64()))
+            else:
+                arrays.append(dict_array(col))
+        names.append('tags')
+        arrays.append(pa.ListArray.from_arrays(pa.array(list(self._tags_offsets), type=pa.int32()), dict_array('tags')))
+        return pa.Table.from_arrays(arrays, names)
+
+    def save(self, path):
+        """
+        save to `path`, .npz requires numpy, .parquet/.arrow/.feather requires pyarrow
+        """
+        ext = os.path.splitext(path)[1].lower()
+        if '.npz' == ext:
+            import numpy as np
+            data = {}
+            for key, value in self.to_dict().items():
+                data[key] = np.array(value, dtype=np.unicode_ if key.endswith('_dict') else None)
+            np.savez_compressed(path, **data)
+        elif '.parquet' == ext:
+            import pyarrow.parquet as pq
+            pq.write_table(self.to_arrow_table(), path)
+        elif ext in ('.arrow', '.feather'):
+            import pyarrow as pa
+            table = self.to_arrow_table()
+            with pa.OSFile(path, 'wb') as sink:
+                writer = pa.RecordBatchFileWriter(sink, table.schema)
+                writer.write_table(table)
+                writer.close()
+        else:
+            raise ValueError('unsupported columnar format: {}'.format(path))
+
+
 def new_uuid_80b():
     """
     :return: 80 bit uuid (40b time + 40b uuid) and base32 encode, len=16
@@ -1,7 +1,67 @@
 from __future__ import print_function, unicode_literals, absolute_import
 
+import os
+import json
+import codecs
+import shutil
+import tempfile
+import multiprocessing
 from unittest import TestCase
-from gherkin_utils.tools import MetaUtils
+from git import Repo
+from gherkin_utils.tools import MetaUtils, MetaColumns, IdLeaseStore, GitRefIdLeaseStore, MetaCodec, LabelingTask, \
+    LabelingDaemon
+
+
+def set_git_user(repo):
+    writer = repo.config_writer()
+    writer.set_value('user', 'name', 'test')
+    writer.set_value('user', 'email', 'test@example.com')
+    writer.release()
+
+
+def new_git_repo(path, bare=False):
+    repo = Repo.init(path, bare=bare)
+    repo.git.symbolic_ref(['HEAD', 'refs/heads/master'])
+    if not bare:
+        set_git_user(repo)
+    return repo
+
+
+def commit_files(repo, files, message='update'):
+    """
+    :param files: {file_name: content}, file is removed if content is None
+    """
+    for file_name, content in files.items():
+        if content is None:
+            repo.git.rm(['--', file_name])
+        else:
+            # encode path by hand, file system encoding may not be utf-8 (e.g. LANG=C)
+            with codecs.open(os.path.join(repo.working_dir, file_name).encode('utf-8'), 'w', encoding='utf-8') as fp:
+                fp.write(content)
+            repo.git.add(['--', file_name])
+    repo.git.commit(['-m', message])
+
+
+def new_feature_text(fuid, fid, name, scenarios=(), tags=()):
+    """
+    :param scenarios: [(suid, sid, name, tags)]
+    :return: content of a labeled feature file
+    """
+    feature_tags = ['@FID.{}'.format(fid), '@FUID.{}'.format(fuid)] + list(tags)
+    summary = {'name': name, 'description': None, 'tags': feature_tags, 'fuid': fuid, 'fid': fid}
+    lines = [MetaUtils.new_feature_meta(fuid, fid, json.dumps(summary)), ' '.join(feature_tags), 'Feature: ' + name]
+    for suid, sid, scenario_name, scenario_tags in scenarios:
+        scenario_tags = ['@SID.{}.{}'.format(fid, sid), '@SUID.{}'.format(suid)] + list(scenario_tags)
+        summary = {'name': scenario_name, 'description': None, 'tags': scenario_tags, 'suid': suid, 'sid': sid,
+                   'type': 'Scenario'}
+        lines += ['  ' + MetaUtils.new_scenario_meta(fuid, suid, sid, json.dumps(summary)),
+                  '  ' + ' '.join(scenario_tags), '  Scenario: ' + scenario_name, '    Given x']
+    return '\n'.join(lines) + '\n'
+
+
+def lease_fids(path, count, queue):
+    store = GitRefIdLeaseStore(path, remote='origin', block_size=3, retries=200)
+    queue.put([store.lease(GitRefIdLeaseStore.FID_SCOPE) for _ in range(count)])
 
 
 class TestMetaUtils(TestCase):
@@ -20,3 +80,343 @@ class TestMetaUtils(TestCase):
         s_meta_line = MetaUtils.new_scenario_meta(fuid, suid, 54321, 'any data')
         self.assertEqual(MetaUtils.split_feature_meta(f_meta_line), (fuid, 12345, 'any data'))
         self.assertEqual(MetaUtils.split_scenario_meta(s_meta_line), (fuid, suid, 54321, 'any data'))
+
+    def test_diff_summaries(self):
+        old = {
+            'A': {'name': 'a', 'tags': ['@x']},
+            'B': {'name': 'b', 'tags': ['@x']},
+            'C': {'name': 'c', 'tags': ['@x']},
+        }
+        new = {
+            'A': {'name': 'a', 'tags': ['@x']},
+            'B': {'name': 'bb', 'tags': ['@y']},
+            'D': {'name': 'd', 'tags': []},
+        }
+        diff = MetaUtils.diff_summaries(old, new, ('name', 'tags'))
+        self.assertEqual(sorted(diff), ['B', 'C', 'D'])
+        self.assertEqual(diff['B']['status'], 'modified')
+        self.assertEqual(diff['B']['changes'], ['name', 'tags'])
+        self.assertEqual(diff['C']['status'], 'removed')
+        self.assertEqual(diff['D']['status'], 'added')
+
+    def test_git_diff_meta(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        fuid_a, fuid_b, fuid_c, fuid_d = 'A' * 16, 'B' * 16, 'C' * 16, 'D' * 16
+        suid_1, suid_2, suid_3, suid_4, suid_5, suid_6 = [str(i) * 16 for i in range(1, 7)]
+        repo = new_git_repo(os.path.join(tmp_dir, 'repo'))
+        commit_files(repo, {
+            'a.feature': new_feature_text(fuid_a, 1, 'a', [(suid_1, 1, 'a1', ['@smoke']), (suid_2, 2, 'a2', []),
+                                                           (suid_3, 3, 'a3', [])]),
+            'c.feature': new_feature_text(fuid_c, 3, 'c', [(suid_5, 1, 'c1', [])]),
+            'd.feature': new_feature_text(fuid_d, 4, 'd', [(suid_6, 1, 'd1', [])]),
+        })
+        commit_files(repo, {
+            # a1 is retagged, a2 is renamed, a3 is removed
+            'a.feature': new_feature_text(fuid_a, 1, 'a', [(suid_1, 1, 'a1', ['@regression']),
+                                                           (suid_2, 2, 'a2 renamed', [])]),
+            '\u4e2d.feature': new_feature_text(fuid_b, 2, 'b', [(suid_4, 1, 'b1', [])]),
+            'c.feature': None,
+        })
+        diff = MetaUtils.git_diff_meta(repo, 'master~1', 'master')
+
+        features = diff['features']
+        self.assertEqual(sorted(features), [fuid_b, fuid_c])
+        self.assertEqual(features[fuid_b]['status'], 'added')
+        self.assertEqual(features[fuid_b]['new']['_file_name'], '\u4e2d.feature')
+        self.assertEqual(features[fuid_c]['status'], 'removed')
+
+        scenarios = diff['scenarios']
+        self.assertEqual(sorted(scenarios), [suid_1, suid_2, suid_3, suid_4, suid_5])
+        self.assertEqual(scenarios[suid_1]['status'], 'modified')
+        self.assertEqual(scenarios[suid_1]['changes'], ['tags'])
+        self.assertEqual(scenarios[suid_2]['status'], 'modified')
+        self.assertEqual(scenarios[suid_2]['changes'], ['name'])
+        self.assertEqual(scenarios[suid_3]['status'], 'removed')
+        self.assertEqual(scenarios[suid_4]['status'], 'added')
+        self.assertEqual(scenarios[suid_5]['status'], 'removed')
+
+
+class TestMetaColumns(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dictionary_encoding(self):
+        columns = MetaColumns()
+        columns.append('master', 'a.feature', 'F' * 16, 1, None, None, 'Feature', 'a', ['@FID.1', '@smoke'])
+        columns.append('master', 'a.feature', 'F' * 16, None, 'S' * 16, 1, 'Scenario', 's', ['@smoke'])
+        data = columns.to_dict()
+        self.assertEqual(len(columns), 2)
+        self.assertEqual(list(data['ref_codes']), [0, 0])
+        self.assertEqual(data['ref_dict'], ['master'])
+        self.assertEqual(data['suid_dict'], ['', 'S' * 16])
+        self.assertEqual(list(data['fid']), [1, -1])
+        self.assertEqual(list(data['sid']), [-1, 1])
+        self.assertEqual(list(data['tags_codes']), [0, 1, 1])
+        self.assertEqual(list(data['tags_offsets']), [0, 2, 3])
+
+    def test_save_npz(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        columns = MetaColumns()
+        columns.append('master', 'a.feature', 'F' * 16, 1, None, None, 'Feature', 'a', ['@FID.1', '@smoke'])
+        columns.append('master', 'a.feature', 'F' * 16, 1, 'S' * 16, 1, 'Scenario', 's', [])
+        path = os.path.join(self.tmp_dir, 'meta.npz')
+        columns.save(path)
+        data = np.load(path)
+        self.assertEqual(data['type_codes'].tolist(), [0, 1])
+        self.assertEqual(data['type_dict'].tolist(), ['Feature', 'Scenario'])
+        self.assertEqual(data['fid'].tolist(), [1, 1])
+        self.assertEqual(data['sid'].tolist(), [-1, 1])
+        self.assertEqual(data['tags_dict'].tolist(), ['@FID.1', '@smoke'])
+        self.assertEqual(data['tags_offsets'].tolist(), [0, 2, 2])
+
+    def test_git_export_meta(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        fuid_a, fuid_b = 'A' * 16, 'B' * 16
+        repo = new_git_repo(os.path.join(self.tmp_dir, 'repo'))
+        commit_files(repo, {'a.feature': new_feature_text(fuid_a, 1, 'a', [('1' * 16, 1, 'a1', ['@smoke'])])})
+        repo.git.checkout(['-b', 'dev'])
+        commit_files(repo, {'\u4e2d:b.feature': new_feature_text(fuid_b, 2, 'b', [('2' * 16, 1, 'b1', [])])})
+
+        path = os.path.join(self.tmp_dir, 'meta.npz')
+        columns = MetaUtils.git_export_meta(repo, path)
+        self.assertEqual(len(columns), 6)
+        data = np.load(path)
+        refs = [data['ref_dict'][code] for code in data['ref_codes']]
+        self.assertEqual(sorted(set(refs)), ['dev', 'master'])
+        paths = [data['path_dict'][code] for code in data['path_codes']]
+        rows = set(zip(refs, paths, [data['name_dict'][code] for code in data['name_codes']],
+                       data['fid'].tolist(), data['sid'].tolist()))
+        self.assertEqual(rows, {('master', 'a.feature', 'a', 1, -1), ('master', 'a.feature', 'a1', 1, 1),
+                                ('dev', 'a.feature', 'a', 1, -1), ('dev', 'a.feature', 'a1', 1, 1),
+                                ('dev', '\u4e2d:b.feature', 'b', 2, -1), ('dev', '\u4e2d:b.feature', 'b1', 2, 1)})
+
+    def test_git_iter_grep_features_no_match(self):
+        repo = new_git_repo(os.path.join(self.tmp_dir, 'repo'))
+        commit_files(repo, {'a.feature': 'Feature: a\n'})
+        self.assertEqual(list(MetaUtils.git_iter_grep_features(repo, MetaUtils.META_PATTERN, 'master')), [])
+
+
+class TestIdLeaseStore(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'ids.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lease(self):
+        store_a = IdLeaseStore(self.db_path, block_size=10)
+        store_b = IdLeaseStore(self.db_path, block_size=10)
+        self.assertEqual(store_a.lease(IdLeaseStore.FID_SCOPE, 5), (5, 15))
+        self.assertEqual(store_b.lease(IdLeaseStore.FID_SCOPE, 5), (15, 25))
+        self.assertEqual(store_b.lease(IdLeaseStore.FID_SCOPE, 30), (30, 40))
+        self.assertEqual(store_a.lease('F' * 16), (1, 11))
+
+    def test_release(self):
+        store = IdLeaseStore(self.db_path, block_size=10)
+        store.lease(IdLeaseStore.FID_SCOPE)
+        store.release(IdLeaseStore.FID_SCOPE, 4, 11)
+        self.assertEqual(store.lease(IdLeaseStore.FID_SCOPE, 1, 5), (4, 9))
+        self.assertEqual(store.lease(IdLeaseStore.FID_SCOPE, 10), (10, 11))
+        self.assertEqual(store.lease(IdLeaseStore.FID_SCOPE), (11, 21))
+
+    def new_labeling_task(self, store):
+        task = LabelingTask(self.tmp_dir, fetch_remote=False, id_store=store)
+        task._fid_idx = {1: {'A' * 16}, 2: {'B' * 16}}
+        task._sid_idx = {('A' * 16, 1): {('A' * 16, '1' * 16)}}
+        task._fid_block, task._sid_blocks = None, {}
+        return task
+
+    def test_labeling_task_new_fid(self):
+        store = IdLeaseStore(self.db_path, block_size=4)
+        task = self.new_labeling_task(store)
+        self.assertEqual(task.new_fid(), 3)
+        task._fid_idx[3] = {'C' * 16}
+        task._fid_idx[4] = {'D' * 16}  # e.g. merged from another ref, should be skipped
+        self.assertEqual(task.new_fid(), 5)
+        # the other job gets the next block
+        self.assertEqual(self.new_labeling_task(store).new_fid(), 7)
+        task.clean()
+        self.assertEqual(store.lease(IdLeaseStore.FID_SCOPE, 3), (6, 7))
+
+    def test_labeling_task_new_sid(self):
+        store = IdLeaseStore(self.db_path, block_size=4)
+        task = self.new_labeling_task(store)
+        fuid_a, fuid_b = 'A' * 16, 'B' * 16
+        self.assertEqual(task.new_sid(fuid_a), 2)
+        self.assertEqual(task.new_sid(fuid_b), 1)
+        self.assertEqual(task.new_sid(fuid_a), 3)
+        self.assertEqual(task._sid_blocks, {fuid_a: [4, 6], fuid_b: [2, 5]})
+        task.clean()
+        self.assertEqual(task._sid_blocks, {})
+        self.assertEqual(store.lease(fuid_a, 2), (4, 6))
+        self.assertEqual(store.lease(fuid_b, 1), (2, 5))
+
+
+class TestGitRefIdLeaseStore(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.upstream_path = os.path.join(self.tmp_dir, 'upstream.git')
+        new_git_repo(self.upstream_path, bare=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def new_clone(self, name):
+        repo = new_git_repo(os.path.join(self.tmp_dir, name))
+        repo.create_remote('origin', self.upstream_path)
+        return repo
+
+    def test_lease_local(self):
+        repo = self.new_clone('a')
+        store_a = GitRefIdLeaseStore(repo, block_size=10)
+        store_b = GitRefIdLeaseStore(repo.working_dir, block_size=10)
+        self.assertEqual(store_a.lease(GitRefIdLeaseStore.FID_SCOPE, 5), (5, 15))
+        self.assertEqual(store_b.lease(GitRefIdLeaseStore.FID_SCOPE, 5), (15, 25))
+        self.assertEqual(store_a.lease('F' * 16), (1, 11))
+        store_b.release(GitRefIdLeaseStore.FID_SCOPE, 20, 25)
+        self.assertEqual(store_a.lease(GitRefIdLeaseStore.FID_SCOPE, 1, 3), (20, 23))
+        self.assertEqual(store_a.lease(GitRefIdLeaseStore.FID_SCOPE, 24), (24, 25))
+        self.assertEqual(store_a.lease(GitRefIdLeaseStore.FID_SCOPE), (25, 35))
+
+    def test_lease_remote(self):
+        store_a = GitRefIdLeaseStore(self.new_clone('a'), remote='origin', block_size=10)
+        store_b = GitRefIdLeaseStore(self.new_clone('b'), remote='origin', block_size=10)
+        self.assertEqual(store_a.lease(GitRefIdLeaseStore.FID_SCOPE), (1, 11))
+        self.assertEqual(store_b.lease(GitRefIdLeaseStore.FID_SCOPE), (11, 21))
+        store_a.release(GitRefIdLeaseStore.FID_SCOPE, 3, 11)
+        self.assertEqual(store_b.lease(GitRefIdLeaseStore.FID_SCOPE, 1, 5), (3, 8))
+        self.assertEqual(store_a.lease(GitRefIdLeaseStore.FID_SCOPE), (8, 11))
+
+    def test_lease_remote_concurrently(self):
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=lease_fids, args=(self.new_clone(str(i)).working_dir, 5, queue))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+        blocks = [block for _ in processes for block in queue.get(timeout=120)]
+        for process in processes:
+            process.join()
+        ids = [i for start, stop in blocks for i in range(start, stop)]
+        self.assertEqual(len(ids), 4 * 5 * 3)
+        self.assertEqual(sorted(ids), list(range(1, 4 * 5 * 3 + 1)))
+
+
+class TestMetaCodec(TestCase):
+    def test_codec(self):
+        summary = {'name': 'a/b \u4e2d\x7f\x1f', 'description': None, 'tags': ['@FID.1'], 'fuid': 'F' * 16, 'fid': 1}
+        expected = json.dumps(summary, separators=(',', ':'))
+        for backend in MetaCodec.BACKENDS:
+            try:
+                codec = MetaCodec(backend)
+            except ValueError:
+                continue
+            self.assertEqual(codec.dumps(summary), expected)
+            self.assertEqual(codec.loads(expected), summary)
+
+    def test_dumps_cached(self):
+        codec = MetaCodec(cache_size=1)
+        self.assertEqual(codec.dumps_cached('a', [1]), '[1]')
+        self.assertEqual(codec.dumps_cached('a', [2]), '[1]')
+        self.assertEqual(codec.dumps_cached('b', [2]), '[2]')
+        self.assertEqual(codec.dumps_cached('a', [3]), '[3]')
+
+    def test_dumps_cached_eviction(self):
+        codec = MetaCodec(cache_size=2)
+        codec.dumps_cached('a', [1])
+        codec.dumps_cached('b', [2])
+        codec.dumps_cached('c', [3])  # 'a' is evicted as the oldest one
+        self.assertEqual(codec.dumps_cached('b', [0]), '[2]')
+        self.assertEqual(codec.dumps_cached('c', [0]), '[3]')
+        self.assertEqual(codec.dumps_cached('a', [0]), '[0]')
+        codec.reserve_cache(1)
+        codec.reserve_cache(4)
+        codec.dumps_cached('d', [4])
+        codec.dumps_cached('e', [5])
+        # cache is grown to 4, nothing is evicted
+        self.assertEqual(codec.dumps_cached('c', [0]), '[3]')
+        self.assertEqual(codec.dumps_cached('a', [1]), '[0]')
+
+
+class TestLabelingDaemon(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def new_upstream(self):
+        upstream_path = os.path.join(self.tmp_dir, 'upstream.git')
+        upstream = new_git_repo(upstream_path, bare=True)
+        seed = new_git_repo(os.path.join(self.tmp_dir, 'seed'))
+        seed.create_remote('origin', upstream_path)
+        commit_files(seed, {'a.feature': 'Feature: a\n  Scenario: a1\n    Given a\n'})
+        seed.git.push(['origin', 'master'])
+        return upstream, seed
+
+    def new_daemon(self, **kwargs):
+        daemon = LabelingDaemon(os.path.join(self.tmp_dir, 'work'), url=os.path.join(self.tmp_dir, 'upstream.git'),
+                                push_to_remote=True, **kwargs)
+        daemon.prepare()
+        set_git_user(daemon._repo)
+        self.addCleanup(daemon.clean)
+        return daemon
+
+    def test_poll(self):
+        upstream, seed = self.new_upstream()
+        daemon = self.new_daemon()
+
+        seed.git.checkout(['-b', 'feature-x'])
+        commit_files(seed, {'b.feature': 'Feature: b\n  Scenario: b1\n    Given b\n'})
+        seed.git.push(['origin', 'feature-x'])
+
+        self.assertEqual(daemon.poll(), {'feature-x'})
+        self.assertIn('# META F ', upstream.git.show('feature-x:b.feature'))
+        self.assertIn('# META S ', upstream.git.show('feature-x:b.feature'))
+        self.assertNotIn('# META', upstream.git.show('master:a.feature'))
+        # push of the daemon itself should not trigger another round
+        self.assertEqual(daemon.poll(), set())
+
+        daemon.trigger('master')
+        self.assertEqual(daemon.poll(), {'master'})
+        self.assertIn('# META F ', upstream.git.show('master:a.feature'))
+
+    def test_poll_rebase(self):
+        upstream, seed = self.new_upstream()
+        seed.git.checkout(['-b', 'x'])
+        commit_files(seed, {'b.feature': 'Feature: b\n  Scenario: b1\n    Given b\n'})
+        seed.git.push(['origin', 'x'])
+        daemon = self.new_daemon(rebase_to='master', branches=['x'])
+
+        daemon.trigger('master', 'x')
+        # x is rebased onto labeled master, which can only be pushed by force
+        self.assertEqual(daemon.poll(), {'master', 'x'})
+        self.assertIn('# META F ', upstream.git.show('x:a.feature'))
+        self.assertIn('# META F ', upstream.git.show('x:b.feature'))
+        self.assertEqual(upstream.git.rev_parse('x~2'), upstream.git.rev_parse('master'))
+
+    def test_poll_retry_failed_branch(self):
+        upstream, seed = self.new_upstream()
+        daemon = self.new_daemon(fetch_interval=0)
+        hook_path = os.path.join(upstream.git_dir, 'hooks', 'pre-receive')
+        with open(hook_path, 'w') as fp:
+            fp.write('#!/bin/sh\nexit 1\n')
+        os.chmod(hook_path, 0o755)
+
+        daemon.trigger('master')
+        self.assertEqual(daemon.poll(), set())
+        self.assertNotIn('# META', upstream.git.show('master:a.feature'))
+
+        os.remove(hook_path)
+        self.assertEqual(daemon.poll(), {'master'})
+        self.assertIn('# META F ', upstream.git.show('master:a.feature'))